@@ -1,8 +1,9 @@
 import polars as pl
 from dotenv import load_dotenv, find_dotenv
-from securedDataPipeline.mongo import get_LO, map_topics, map_tags, objects_index_col, get_collections
-from pyarrow import field, string, struct
+from securedDataPipeline.mongo import get_LO, get_released_authors, map_topics_expr, map_tags_expr, get_collections
+from securedDataPipeline.helper import query_params_to_columns
 from os import environ
+from re import escape
 from google.analytics.data_v1beta import BetaAnalyticsDataClient
 from google.analytics.data_v1beta.types import (
     DateRange,
@@ -13,9 +14,8 @@ from google.analytics.data_v1beta.types import (
     FilterExpression,
     FilterExpressionList,
 )
-from google.api_core.exceptions import InvalidArgument
-from pymongoarrow.api import Schema
-from google.protobuf.json_format import MessageToDict
+from google.api_core.exceptions import InvalidArgument, ResourceExhausted, ServiceUnavailable
+from google.api_core.retry import Retry, if_exception_type
 
 load_dotenv(find_dotenv())
 
@@ -44,6 +44,43 @@ ga4_creds = {
 
 ga4_client = BetaAnalyticsDataClient.from_service_account_info(ga4_creds)
 property_id = "332215249"
+# Back off exponentially when the GA4 quota is exhausted instead of failing the report
+ga4_retry = Retry(
+    predicate=if_exception_type(ResourceExhausted, ServiceUnavailable),
+    initial=1.0,
+    multiplier=2.0,
+    maximum=32.0,
+    timeout=300.0,
+)
+
+
+def run_report_df(report_req: RunReportRequest, dimension: str, metric: str) -> pl.DataFrame:
+    """
+    Runs a GA4 report of one dimension and one metric
+
+    Parameters
+    ----------
+    report_req: RunReportRequest
+        - The report to run
+    dimension: str
+        - Column name for the report's dimension values
+    metric: str
+        - Column name for the report's metric values
+
+    Returns
+    -------
+    pl.DataFrame of the report's rows, read straight from the protobuf response
+    instead of converting every row into a dictionary first
+    """
+    rows = ga4_client.run_report(report_req, retry=ga4_retry)._pb.rows
+
+    return pl.DataFrame(
+        {
+            dimension: [row.dimension_values[0].value for row in rows],
+            metric: [row.metric_values[0].value for row in rows],
+        },
+        schema={dimension: pl.String, metric: pl.String},
+    ).with_columns(pl.col(metric).cast(pl.Int32))
 
 
 def getBrowsePageViews(startDate: str = "2015-08-14", endDate: str = "today"):
@@ -63,11 +100,12 @@ def getBrowsePageViews(startDate: str = "2015-08-14", endDate: str = "today"):
     pl.DataFrame with the following columns:
             - url: The URL of the page visited
             - visits: The number of visits to that page
+            - text: The search term used
+            - currPage: The page of results visited
             - topics: List of topics associated with the page
             - tags: List of tags associated with the page
+            - Any other query param of the URL, as a list of its values
     """
-    from urllib.parse import parse_qs, urlparse
-
     try:
         browse_req = RunReportRequest(
             property=f"properties/{property_id}",
@@ -108,69 +146,39 @@ def getBrowsePageViews(startDate: str = "2015-08-14", endDate: str = "today"):
         print(e)
         return
 
-    ga4_res = MessageToDict(ga4_client.run_report(browse_req)._pb)
+    url_df = run_report_df(browse_req, "url", "visits")
     # Return empty DataFrame if no rows exist in the response
-    if "rows" not in ga4_res:
+    if url_df.is_empty():
         return pl.DataFrame()
 
+    url_df = query_params_to_columns(
+        # Filter out routes with unnecessary queries
+        url_df.filter(
+            # No queries provided
+            pl.col("url").str.contains(r"\?")
+            # URL not encoded properly, or for translate this page to 'x' language
+            & ~pl.col("url").str.contains(r"amp;|[\?&]_x_")
+        ),
+        "url",
+    )
+
+    # Not every report has URLs with all of these query params
+    url_df = url_df.with_columns(
+        pl.lit(None, dtype=pl.List(pl.String)).alias(param)
+        for param in ("text", "currPage", "topics", "tags")
+        if param not in url_df.columns
+    )
+
     url_df = (
-        (
-            pl.DataFrame(ga4_res["rows"])
-            .with_columns(
-                [
-                    pl.col("dimensionValues").explode().struct[0].alias("url"),
-                    pl.col("metricValues")
-                    .explode()
-                    .struct[0]
-                    .cast(pl.Int32)
-                    .alias("visits"),
-                ]
-            )
-            .filter(
-                # Filter out routes with unnecessary queries
-                [
-                    # No queries provided
-                    pl.col("url").str.contains(r"\?"),
-                    # URL not encoded properly
-                    ~pl.col("url").str.contains(r"amp;"),
-                    # For translate this page to 'x' language
-                    ~pl.col("url").str.contains(r"[\?&]_x_")
-                ]
-            )
-            .select(["url", "visits"])
-            .with_columns(
-                # query params to dictionary
-                pl.col("url").map_elements(
-                    lambda u: parse_qs(urlparse(u).query),
-                    # TODO: Couldn't satisfy the proper return data type. Will have to revisit later
-                    # return_dtype=pl.Struct,
-                ),
-            )
-            # create a column for each query parameter
-            .unnest("url")
-        )
-        .explode("text")
+        url_df.explode("text")
         .explode("currPage")
+        .with_columns(
+            pl.col("currPage").cast(pl.Int32, strict=False),
+            map_topics_expr(),
+            map_tags_expr(),
+        )
     )
 
-    if "topics" in url_df.columns:
-        try:
-            url_df = url_df.with_columns(
-                pl.col("topics").map_elements(
-                    map_topics, return_dtype=pl.List(pl.String)
-                )
-            )
-        except pl.exceptions.ComputeError as err:
-            print(err)
-
-    if "tags" in url_df.columns:
-        try:
-            url_df = url_df.with_columns(
-                pl.col("tags").map_elements(map_tags, return_dtype=pl.List(pl.String))
-            )
-        except pl.exceptions.ComputeError as err:
-            print(err)
-
     return url_df
 
 
@@ -193,25 +201,13 @@ def getDetailPageViews(startDate: str = "2015-08-14", endDate: str = "today") ->
         - views: The number of views for that learning object
     """
 
-    authors = objects_index_col.find_polars_all(
-        {"status": "released"},
-        schema=Schema(
-            {
-                "cuid": string(),
-                "author": struct(
-                    [
-                        field("username", string()),
-                    ]
-                ),
-            }
-        ),
-    ).unnest("author")
-
-    # Create URL paths for learning objects
-    url_path = []
-    for cuid, author in authors.iter_rows():
-        url_path.append(f"/details/{author}/{cuid}")
-    url_path = pl.Series(url_path)
+    # URL paths of released learning objects. Lowercased since GA4's CONTAINS match
+    # that used to select them is case-insensitive
+    released_paths = get_released_authors().select(
+        pl.format("/details/{}/{}", pl.col("username"), pl.col("cuid"))
+        .str.to_lowercase()
+        .alias("path")
+    )
 
     try:
         # GA4 report for learning object page views
@@ -220,85 +216,78 @@ def getDetailPageViews(startDate: str = "2015-08-14", endDate: str = "today") ->
             dimensions=[Dimension(name="pagePath")],
             metrics=[Metric(name="screenPageViews")],
             date_ranges=[DateRange(start_date=startDate, end_date=endDate)],
-            # Get the reports from learning object links
             dimension_filter=FilterExpression(
-                or_group=FilterExpressionList(
+                and_group=FilterExpressionList(
                     expressions=[
                         FilterExpression(
                             filter=Filter(
                                 field_name="pagePath",
+                                # Get the reports from learning object links. Non-released
+                                # objects are dropped after the response is joined with authors
                                 string_filter=Filter.StringFilter(
-                                    value=path,
-                                    match_type=Filter.StringFilter.MatchType(4),
+                                    value="/details/",
+                                    match_type=Filter.StringFilter.MatchType(2),
                                 ),
                             )
-                        )
-                        for path in url_path
+                        ),
+                        FilterExpression(
+                            # Filter out error pages
+                            not_expression=FilterExpression(
+                                filter=Filter(
+                                    field_name="pagePath",
+                                    string_filter=Filter.StringFilter(
+                                        value="/unauthorized",
+                                        match_type=Filter.StringFilter.MatchType(4),
+                                    ),
+                                )
+                            )
+                        ),
                     ]
                 )
             ),
+            limit=200_000,
         )
     except InvalidArgument as e:
         print(e)
         return None
 
-    ga4_res = MessageToDict(ga4_client.run_report(views_req)._pb)
+    # URL path and page views
+    views_df = run_report_df(views_req, "lo_cuid", "views")
     # Return empty DataFrame if no rows exist in the response
-    if "rows" not in ga4_res:
+    if views_df.is_empty():
         return pl.DataFrame()
 
-    # Protobuf to dictionary to Dataframe
-    views_df = pl.DataFrame(ga4_res["rows"])
-    views_df = (
-        (
-            views_df.with_columns(
-                [
-                    # URL Path
-                    pl.col("dimensionValues")
-                    .explode()
-                    .struct.unnest()
-                    .alias("lo_cuid"),
-                    # Page views
-                    pl.col("metricValues")
-                    .explode()
-                    .struct.unnest()
-                    .alias("views")
-                    .cast(pl.Int32),
-                ]
-            )
-            .select(["lo_cuid", "views"])
-            # Filter out error pages
-            .filter(~pl.col("lo_cuid").str.contains("/unauthorized"))
-        )
+    views_lf = (
+        views_df.lazy()
         .with_columns(
-            # Only keep the cuid from the url path. Omit the rest
-            pl.col("lo_cuid").str.split("/").list.get(3)
+            # Only keep the author and cuid part of the url path. Omit the rest
+            pl.col("lo_cuid")
+            .str.extract(r"^(/details/[^/]+/[^/]+)", 1)
+            .str.to_lowercase()
+            .alias("path"),
+            # Only keep the cuid from the url path
+            pl.col("lo_cuid").str.extract(r"^/details/[^/]+/([^/]+)", 1),
         )
+        # Only keep the views of released learning objects
+        .join(released_paths.lazy(), on="path", how="semi")
         # Disregard version and just add up all of their views
         .group_by("lo_cuid")
         .agg(pl.col("views").sum())
         # Join with LO table
-    ).join(get_LO(), left_on="lo_cuid", right_on="cuid")
+    ).join(
+        get_LO(fields=("cuid", "name", "collection", "topics", "tags")).lazy(),
+        left_on="lo_cuid",
+        right_on="cuid",
+    )
 
-    if "topics" in views_df.columns:
-        try:
-            views_df = views_df.with_columns(
-                pl.col("topics").map_elements(
-                    map_topics, return_dtype=pl.List(pl.String)
-                )
-            )
-        except pl.exceptions.ComputeError as err:
-            print(err)
+    views_cols = views_lf.collect_schema().names()
+    if "topics" in views_cols:
+        views_lf = views_lf.with_columns(map_topics_expr())
 
-    if "tags" in views_df.columns:
-        try:
-            views_df = views_df.with_columns(
-                pl.col("tags").map_elements(map_tags, return_dtype=pl.List(pl.String))
-            )
-        except pl.exceptions.ComputeError as err:
-            print(err)
+    if "tags" in views_cols:
+        views_lf = views_lf.with_columns(map_tags_expr())
 
-    return views_df
+    return views_lf.collect()
 
 def getCollectionPageViews(startDate: str = "2015-08-14", endDate: str = "today") -> pl.DataFrame | None:
     """
@@ -322,12 +311,9 @@ def getCollectionPageViews(startDate: str = "2015-08-14", endDate: str = "today"
     collections = get_collections()["abvName"].to_list()
 
     # Store all of the links of collection pages within a regex
-    collection_group = "|".join(collections)
+    collection_group = "|".join(map(escape, collections))
     # Some collection pages have /c/ and /collections/ in their path
-    regex_pattern = (
-        fr"|^/c/({collection_group})$"
-        fr"|^/collections/({collection_group})$"
-    )
+    regex_pattern = fr"^/(?:c|collections)/(?:{collection_group})$"
     try:
         views_req = RunReportRequest(
             property=f"properties/{property_id}",
@@ -349,18 +335,13 @@ def getCollectionPageViews(startDate: str = "2015-08-14", endDate: str = "today"
         print(e)
         return None
 
-    ga4_res = MessageToDict(ga4_client.run_report(views_req)._pb)
+    views_df = run_report_df(views_req, "collection", "views")
     # Return empty DataFrame if no rows exist in the response
-    if "rows" not in ga4_res:
+    if views_df.is_empty():
         return pl.DataFrame()
 
-    # Protobuf to dictionary to Dataframe
-    views_df = pl.DataFrame(ga4_res["rows"])
-
     # Get dataframe of collection page views
-    return views_df.with_columns([
-        (pl.col("dimensionValues").list.get(0).struct.field("value").str.split("/").list.get(-1).alias("collection")),
-
-        # Get the number of views and cast as int
-        pl.col("metricValues").list.get(0).struct.field("value").alias("views").cast(pl.Int32),
-    ]).select(["collection", "views"])
+    return views_df.with_columns(
+        # Only keep the collection name from the url path
+        pl.col("collection").str.extract(r"/([^/]+)$", 1)
+    )
@@ -1,46 +1,107 @@
 import polars as pl
-from bson.objectid import ObjectId
+from urllib.parse import unquote_plus
 
 
-def objID_to_string(df: pl.DataFrame, col: str) -> pl.DataFrame:
+def objID_to_string(df: pl.DataFrame | pl.LazyFrame, col: str) -> pl.DataFrame | pl.LazyFrame:
     """
     Convert binary ObjectID into its string value
     Args:
-        df: pl.DataFrame
+        df: pl.DataFrame | pl.LazyFrame
             - Dataframe to convert it's column from objectID with
         col: str
             - The column to convert from objectID to string
     """
-    return df.with_columns(
-        [
-            pl.col(col)
-            .cast(pl.Binary)
-            .map_elements(lambda o: str(ObjectId(o)), return_dtype=pl.String)
-        ]
-    )
+    return df.with_columns(objID_to_string_expr(col))
 
 
-def parse_ISO8601(col_name: str) -> pl.Expr:
-    import pendulum as pm
+def objID_to_string_expr(col_name: str) -> pl.Expr:
+    """
+    Return a polars expression that converts a binary ObjectID column into its string value
+    """
+    # The string value of an ObjectID is the hex encoding of its 12 bytes
+    return pl.col(col_name).cast(pl.Binary).bin.encode("hex")
+
+
+def objID_to_datetime(col_name: str) -> pl.Expr:
     """
-    Return a polars expression that parses string column that represent date to be of Date object
+    Return a polars expression that gets the creation time of a binary ObjectID column,
+    same as ObjectId.generation_time
     """
+    # The first 4 bytes of an ObjectID are its creation time in big-endian unix seconds
+    seconds = (
+        objID_to_string_expr(col_name)
+        .str.slice(0, 8)
+        .str.to_integer(base=16)
+    )
+
+    return pl.from_epoch(seconds, time_unit="s").dt.replace_time_zone("UTC")
 
-    def normalize_dates(date: str) -> str:
-        from re import sub
 
-        """
-        Some of the data entries in our CLARK database have erroneous dates,
-        so some string date format isn't parseable by pendulum: 2018-03-13T17:13:12.000000+00:00Z
-        There's a need to convert it to: 2018-09-14T11:53:41.812000Z so that pendulum can parse it
-        Basically removing the +00:00 part
-        """
-        return sub(r"(\+\d{2}:\d{2})Z$", r"\1", date)
+def query_params_to_columns(df: pl.DataFrame, col: str) -> pl.DataFrame:
+    """
+    Create a column for each query parameter of a URL column, same as parse_qs
+    Args:
+        df: pl.DataFrame
+            - Dataframe with the URL column
+        col: str
+            - The column of URLs. Each query parameter becomes a list of its decoded values
+    """
+    # One row per key=value pair of the query string. Blank values are skipped like parse_qs
+    params_df = (
+        df.with_row_index("_row")
+        .select(
+            "_row",
+            pl.col(col).str.extract(r"\?([^#]*)", 1).str.split("&").alias("_param"),
+        )
+        .explode("_param")
+        .select(
+            "_row",
+            pl.col("_param").str.extract(r"^([^=]+)=", 1).alias("_key"),
+            pl.col("_param").str.extract(r"^[^=]+=(.+)$", 1).alias("_value"),
+        )
+        .drop_nulls()
+    )
+
+    # Only decode each distinct key and value once instead of every row
+    encoded = pl.concat([params_df["_key"], params_df["_value"]]).unique().to_list()
+    decoded = {e: unquote_plus(e) for e in encoded}
 
-    parse_date_exp = pl.col(col_name).map_elements(
-        lambda d: pm.parse(normalize_dates(d)).date(), return_dtype=pm.Date
+    params_df = (
+        params_df.with_columns(
+            pl.col("_key", "_value").replace_strict(decoded, return_dtype=pl.String)
+        )
+        .group_by("_row", "_key", maintain_order=True)
+        .agg("_value")
     )
 
-    return parse_date_exp
+    if params_df.is_empty():
+        return df
+
+    params_df = params_df.pivot(on="_key", index="_row", values="_value")
+
+    return df.with_row_index("_row").join(params_df, on="_row", how="left").drop("_row")
 
 
+def parse_ISO8601(col_name: str) -> pl.Expr:
+    """
+    Return a polars expression that parses string column that represent date to be of Date object.
+    Dates keep their local date like pendulum did, and unparseable dates become null
+    """
+    # Some of the data entries in our CLARK database have erroneous dates,
+    # so some string date format isn't parseable: 2018-03-13T17:13:12.000000+00:00Z
+    # There's a need to convert it to: 2018-03-13T17:13:12.000000 so that it can be parsed
+    # Basically removing the offset and the trailing Z, which also keeps the local date
+    # A space is also a valid separator between the date and time: 2018-09-14 11:53:41
+    normalized_exp = (
+        pl.col(col_name)
+        .str.replace(r"^(\d{4}-\d{2}-\d{2}) ", "${1}T")
+        .str.replace(r"(?:[+-]\d{2}:?\d{2})?Z?$", "")
+    )
+
+    return pl.coalesce(
+        normalized_exp.str.to_datetime("%Y-%m-%dT%H:%M:%S%.f", strict=False).dt.date(),
+        # Timestamps without seconds: 2018-09-14T11:53Z
+        normalized_exp.str.to_datetime("%Y-%m-%dT%H:%M", strict=False).dt.date(),
+        # Plain dates like 2018-09-14 are valid ISO 8601 too
+        normalized_exp.str.to_date("%Y-%m-%d", strict=False),
+    )
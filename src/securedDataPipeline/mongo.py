@@ -1,18 +1,19 @@
 import polars as pl
-import pendulum as pm
 from pymongo import MongoClient
-from securedDataPipeline.helper import objID_to_string
-from bson.objectid import ObjectId
-from datetime import datetime, timezone
+from pymongo.collection import Collection
+from securedDataPipeline.helper import objID_to_string, objID_to_string_expr, objID_to_datetime
 from dotenv import load_dotenv, find_dotenv
 from os import getenv
+from sys import exit
+from functools import cache
 
 # pyarrow types
-from pyarrow import field, list_, string, struct, int32
+from pyarrow import field, string, struct
 from pymongoarrow.api import Schema
+from pymongoarrow.types import ObjectIdType
 from pymongoarrow.monkey import patch_all
 
-from typing import List
+from typing import Dict, List, Tuple
 
 patch_all()
 load_dotenv(find_dotenv())
@@ -39,10 +40,10 @@ submissions_col = onion_db["submissions"]
 cae_orgs_col = card_db["organizations"]
 collections_col = onion_db["collections"]
 card_user_col = card_db["users"]
-ratings_col = onion_db["ratings"]
 files_col = files_db["files"]
 
 
+@cache
 def get_collections():
     collections_df = collections_col.find_polars_all({})
     return collections_df
@@ -58,87 +59,223 @@ def get_files():
     return files_col.find_polars_all({}, projection={"extension": "$extension"})
 
 
-try:
-    # Checks if any of the collections are missing
-    for col in [
-        objects_index_col,
-        users_col,
-        downloads_col,
-        topics_col,
-        tags_col,
-        ratings_col,
-        submissions_col,
-        cae_orgs_col,
-        collections_col,
-        card_user_col,
-    ]:
-        count = col.count_documents({})
-        if count == 0:
-            raise Exception(f"Collection '{col.name}' is empty")
-except Exception as e:
-    from sys import exit
-
-    print("Make sure to pull the appropriate data")
-    exit(1)
-
-# Maps attributes of type list with their respective names from different collections
-topics_df = objID_to_string(df=topics_col.find_polars_all({}), col="_id")
-topicID_to_name = topics_df.select([pl.col("_id"), pl.col("name")]).to_dict(
-    as_series=False
-)
-topic_dict = dict(zip(topicID_to_name["_id"], topicID_to_name["name"]))
+def verify_collections() -> None:
+    """
+    Exits if any of the collections are missing or empty
+    """
+    try:
+        for col in [
+            objects_index_col,
+            users_col,
+            downloads_col,
+            topics_col,
+            tags_col,
+            ratings_col,
+            submissions_col,
+            cae_orgs_col,
+            collections_col,
+            card_user_col,
+        ]:
+            # Only look for a single document instead of counting all of them
+            if col.find_one({}, projection={"_id": 1}) is None:
+                raise Exception(f"Collection '{col.name}' is empty")
+    except Exception:
+        print("Make sure to pull the appropriate data")
+        exit(1)
+
+
+def create_indexes() -> None:
+    """
+    Creates the indexes the queries in this module rely on. Safe to run more than once
+    """
+    # Released learning objects are looked up by status for the GA page views
+    objects_index_col.create_index(
+        [("status", 1)],
+        name="status_released",
+        partialFilterExpression={"status": "released"},
+    )
 
-tags_df = objID_to_string(df=tags_col.find_polars_all({}), col="_id")
-tagsID_to_name = tags_df.select([pl.col("_id"), pl.col("name")]).to_dict(
-    as_series=False
-)
-tag_dict = dict(zip(tagsID_to_name["_id"], tagsID_to_name["name"]))
 
-orgs_df = objID_to_string(df=cae_orgs_col.find_polars_all({}), col="_id")
-orgID_to_name = orgs_df.select([pl.col("_id"), pl.col("name")])
-org_dict = dict(zip(orgID_to_name["_id"], orgID_to_name["name"]))
+# Maps attributes of type list with their respective names from different collections.
+# The lookups are fetched on first use so importing the module doesn't query these collections,
+# and only the ID and name are fetched, with the ID kept as raw ObjectID bytes
+_id_name_schema = Schema({"_id": ObjectIdType(), "name": string()})
+
+
+def _id_to_name(col: Collection) -> Dict[str, str]:
+    # Read straight from the Arrow table, without a polars dataframe in between
+    table = col.find_arrow_all({}, projection={"name": 1}, schema=_id_name_schema)
+    ids = table["_id"].combine_chunks().storage.to_pylist()
+    return dict(zip((id.hex() for id in ids), table["name"].to_pylist()))
+
+
+@cache
+def _topic_dict() -> Dict[str, str]:
+    return _id_to_name(topics_col)
+
+
+@cache
+def _tag_dict() -> Dict[str, str]:
+    return _id_to_name(tags_col)
+
+
+@cache
+def _org_dict() -> Dict[str, str]:
+    return _id_to_name(cae_orgs_col)
 
 
 def map_topics(ids) -> List[str]:
     if pl.Series(ids).is_empty():
         return ["No Topic"]
 
+    topic_dict = _topic_dict()
     return [topic_dict.get(id, f"Unknown Topic ({id})") for id in ids]
 
 
 def map_tags(ids) -> List[str]:
+    tag_dict = _tag_dict()
     return [tag_dict.get(id, f"Unknown Tag ({id})") for id in ids]
 
 
 def map_card_orgs(ids) -> List[str]:
+    org_dict = _org_dict()
     return [org_dict.get(id, f"Unknown Organization ({id})") for id in ids]
 
 
-def get_LO(is_index: bool = False) -> pl.DataFrame:
+def map_topics_expr(col_name: str = "topics") -> pl.Expr:
+    """
+    Return a polars expression that maps a list column of topic IDs to their names.
+    Same as map_topics, but runs natively in polars instead of per row in Python.
+    Names are categorical since only a few hundred distinct topics exist
+    """
+    names = pl.col(col_name).list.eval(
+        pl.element().cast(pl.String).replace_strict(
+            _topic_dict(),
+            default=pl.format("Unknown Topic ({})", pl.element()),
+            return_dtype=pl.String,
+        )
+    )
+
+    # Map as strings and cast once at the end, mapping straight to Categorical breaks on some polars versions
+    return (
+        pl.when(pl.col(col_name).list.len() == 0)
+        .then(pl.lit(["No Topic"], dtype=pl.List(pl.String)))
+        .otherwise(names)
+        .cast(pl.List(pl.Categorical))
+        .alias(col_name)
+    )
+
+
+def map_tags_expr(col_name: str = "tags") -> pl.Expr:
+    """
+    Return a polars expression that maps a list column of tag IDs to their names.
+    Same as map_tags, but runs natively in polars instead of per row in Python.
+    Names are categorical since only a few hundred distinct tags exist
+    """
+    return pl.col(col_name).list.eval(
+        pl.element().cast(pl.String).replace_strict(
+            _tag_dict(),
+            default=pl.format("Unknown Tag ({})", pl.element()),
+            return_dtype=pl.String,
+        )
+    ).cast(pl.List(pl.Categorical))
+
+
+def map_card_orgs_expr(col_name: str = "Organizations") -> pl.Expr:
+    """
+    Return a polars expression that maps a list column of CARD organization IDs to their names.
+    Same as map_card_orgs, but runs natively in polars instead of per row in Python
+    """
+    return pl.col(col_name).list.eval(
+        pl.element().cast(pl.String).replace_strict(
+            _org_dict(),
+            default=pl.format("Unknown Organization ({})", pl.element()),
+            return_dtype=pl.String,
+        )
+    )
+
+
+@cache
+def get_LO(is_index: bool = False, fields: Tuple[str, ...] | None = None) -> pl.DataFrame:
     """
-    Maps out tags and topics with their respective names into a learning objects dataframe
+    Maps out tags and topics with their respective names into a learning objects dataframe.
+    Cached per process, see clear_cache
+
+    Args:
+        is_index: bool
+            - Read from onion.objects-index and map topics/tags instead of onion.objects
+        fields: Tuple[str, ...] | None
+            - Only fetch these fields from the database. Fetches every field if None
 
     Returns a dataframe of onion.objects, excluding _id
     """
+    # Only ship the requested fields from the database
+    projection = dict.fromkeys(fields, 1) if fields else None
+
     if is_index:
         # Read in learning objects from objects_index_col and map topics/tags
-        df = (
-            objects_index_col.find_polars_all({})
-            .with_columns(
-                pl.col("topics").map_elements(
-                    map_topics, return_dtype=pl.List(pl.String)
-                ),
-                pl.col("tags").map_elements(map_tags, return_dtype=pl.List(pl.String)),
-            )
-            .rename({"objectCollection": "collection"})
-        )
+        df = objects_index_col.find_polars_all({}, projection=projection)
+        # Map whichever of the columns were fetched in a single with_columns
+        mappings = []
+        if "topics" in df.columns:
+            mappings.append(map_topics_expr())
+
+        if "tags" in df.columns:
+            mappings.append(map_tags_expr())
+
+        # Only a handful of statuses and collections exist, so store them as categoricals
+        for col_name in ["status", "objectCollection"]:
+            if df.schema.get(col_name) == pl.String:
+                mappings.append(pl.col(col_name).cast(pl.Categorical))
+
+        df = df.with_columns(mappings).rename({"objectCollection": "collection"}, strict=False)
     else:
         # Read in learning objects from objects_col without mapping
-        df = objects_col.find_polars_all({})
+        df = objects_col.find_polars_all({}, projection=projection)
 
     return df
 
 
+_released_authors_schema = Schema(
+    {
+        "cuid": string(),
+        "author": struct(
+            [
+                field("username", string()),
+            ]
+        ),
+    }
+)
+
+
+@cache
+def get_released_authors() -> pl.DataFrame:
+    """
+    Cached per process, see clear_cache
+
+    Returns a dataframe of the cuid and author username of every released learning object
+    """
+    return objects_index_col.find_polars_all(
+        {"status": "released"}, schema=_released_authors_schema
+    ).unnest("author")
+
+
+def clear_cache() -> None:
+    """
+    Clears the cached lookups and dataframes so the next call fetches them from the database again
+    """
+    for cached in [
+        _topic_dict,
+        _tag_dict,
+        _org_dict,
+        get_collections,
+        get_LO,
+        get_released_authors,
+        get_CAE_orgs,
+    ]:
+        cached.cache_clear()
+
+
 def get_downloads() -> pl.DataFrame:
     """
     Returns a dataframe of onions.downloads, excluding _id
@@ -150,8 +287,9 @@ def get_downloads() -> pl.DataFrame:
                 "Timestamp": "$timestamp",
                 "cuid": "$learningObject.cuid",
                 "downloadedBy": "$downloadedBy",
+                "_id": 0,
             },
-        ).select(pl.exclude("_id")),
+        ),
         col="downloadedBy",
     )
 
@@ -168,12 +306,14 @@ def get_submissions() -> pl.DataFrame:
             "lo_id": "$learningObjectId",
             "collection": "$collection",
             "timestamp": "$timestamp",
+            "_id": 0,
         },
-    ).select(pl.exclude("_id"))
+    )
 
     return submissions_df
 
 
+@cache
 def get_CAE_orgs() -> pl.DataFrame:
     """
     Returns a dataframe of CARD.organizations, excluding _id
@@ -183,8 +323,9 @@ def get_CAE_orgs() -> pl.DataFrame:
         projection={
             "Name": "$name",
             "Type": "$type",
+            "_id": 0,
         },
-    ).select(pl.exclude("_id"))
+    )
 
     return cae_orgs_df
 
@@ -203,13 +344,12 @@ def get_card_users() -> pl.DataFrame:
         },
     ).with_columns(
         [
-            # Convert ObjectId to string
-            pl.col("_id")
-            .map_elements(lambda o: ObjectId(o).generation_time, return_dtype=datetime)
-            .alias("createdAt"),
+            # Creation time of the user from its ObjectId
+            objID_to_datetime("_id").alias("createdAt"),
             # Map organization IDs to names
-            pl.col("Organization").map_elements(
-                lambda org_id: org_dict.get(org_id, f"Unknown Organization ({org_id})"),
+            pl.col("Organization").cast(pl.String).replace_strict(
+                _org_dict(),
+                default=pl.format("Unknown Organization ({})", pl.col("Organization")),
                 return_dtype=pl.String,
             ),
         ]
@@ -227,7 +367,6 @@ def get_card_resources() -> pl.DataFrame:
         .find_polars_all(
             {},
             projection={
-                "id": "$_id",
                 "Name": "$name",
                 "Status": "$status",
                 "URL": "$url",
@@ -238,24 +377,12 @@ def get_card_resources() -> pl.DataFrame:
         )
         .with_columns(
             [
-                pl.col("Organizations").map_elements(
-                    map_card_orgs, return_dtype=pl.List(pl.String)
-                ),
-                pl.col("_id")
-                .map_elements(
-                    lambda o: ObjectId(o).generation_time,
-                    # return_dtype=pl.Datetime(time_unit="us", time_zone="UTC"),
-                )
-                .alias("Created"),
+                map_card_orgs_expr(),
+                # Creation time of the resource from its ObjectId
+                objID_to_datetime("_id").alias("Created"),
+                objID_to_string_expr("_id"),
             ]
         )
-        .with_columns(
-            pl.col("Created").map_elements(
-                lambda x: pm.instance(x),
-                # return_dtype=pl.Date
-            )
-        )
-        .select(pl.exclude("id"))
     )
 
     return card_resources_df
@@ -273,7 +400,8 @@ def get_ratings() -> pl.DataFrame:
             "User": "$user",
             "Source": "$source",
             "Date": "$date",
+            "_id": 0,
         },
-    ).select(pl.exclude("_id"))
+    )
 
     return ratings_df